@@ -0,0 +1,15 @@
+from typing import List
+import re
+
+# Matches one comma-separated hashtag, skipping leading '#' and whitespace
+HASHTAG_RE = re.compile(r'[#\s]*([^,\s#][^,]*?)\s*(?:,|$)')
+
+def process_hashtags(hashtags: str) -> List[str]:
+    """
+    Process hashtags string into proper format.
+    Returns list of hashtags with # prefix.
+    """
+    if not hashtags:
+        return None
+    
+    return [f'#{tag}' for tag in HASHTAG_RE.findall(hashtags)] or None
@@ -1,192 +1,593 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form
-from fastapi.responses import JSONResponse
-from typing import List, Optional
+from fastapi import FastAPI, HTTPException, Request
+from starlette.requests import ClientDisconnect
+from fastapi.responses import JSONResponse, Response
+from typing import Optional
 import os
 import shutil
 import tempfile
-from tiktokautouploader import upload_tiktok
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.parser import ParseFailedException
+from streaming_form_data.targets import BaseTarget, ValueTarget
+from streaming_form_data.validators import MaxSizeValidator, ValidationError
+from uploader import BROWSER_POOL_SIZE, cookie_path, run_upload_in_thread
+import aiofiles
+import orjson
 import logging
+import logging.handlers
+import queue
 import asyncio
-from functools import partial
+import contextlib
+import errno
+import hashlib
 import threading
+import uuid
+import weakref
 
-app = FastAPI(title="TikTok Uploader API")
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Install the queue handler here rather than at import time: "python main.py" imports this
+    # module a second time as "main", and only the copy serving the app drains its queue
+    log_listener.start()
+    logging.getLogger().addHandler(log_queue_handler)
+    try:
+        yield
+    finally:
+        logging.getLogger().removeHandler(log_queue_handler)
+        log_listener.stop()
+
+class ORJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson, which is much faster than the stdlib encoder."""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
 
-# Global lock to prevent concurrent uploads
+app = FastAPI(title="TikTok Uploader API", lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# Global lock guarding the count of active uploads
 upload_lock = threading.Lock()
-upload_in_progress = False
+active_uploads = 0
 
-# Configure detailed logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+# Set whenever a browser slot is returned; wakes background jobs waiting for one
+slot_released = asyncio.Event()
+
+# Concurrent uploads allowed per TikTok account
+ACCOUNT_UPLOAD_LIMIT = int(os.getenv('ACCOUNT_UPLOAD_LIMIT', '1'))
+
+# Per-account upload semaphores; entries drop out once no request holds or waits on them
+account_semaphores = weakref.WeakValueDictionary()
+
+# Background upload jobs by id, oldest first, plus the tasks running them
+upload_jobs = {}
+background_jobs = set()
+MAX_TRACKED_JOBS = 1000
+
+# Background uploads allowed to be accepted or waiting at once; each holds a staged video
+MAX_PENDING_JOBS = int(os.getenv('MAX_PENDING_JOBS', str(4 * BROWSER_POOL_SIZE)))
+pending_jobs = 0
+
+# Configure detailed logging; records are queued and written by a background listener
+# thread so request handlers never block on stream writes
+log_queue = queue.SimpleQueue()
+log_stream_handler = logging.StreamHandler()
+log_stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+log_listener = logging.handlers.QueueListener(log_queue, log_stream_handler)
+log_queue_handler = logging.handlers.QueueHandler(log_queue)
+logging.getLogger().setLevel(logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Get cookie directory from environment variable
-COOKIE_DIR = os.getenv('COOKIE_DIR', '/data/cookies')
+# Preferred directory for intermediate videos; a tmpfs keeps them in RAM instead of on disk
+UPLOAD_TMP_DIR = os.getenv('UPLOAD_TMP_DIR', '/dev/shm')
+with contextlib.suppress(OSError):
+    os.makedirs(UPLOAD_TMP_DIR, exist_ok=True)
+
+# Bytes promised to videos staged in UPLOAD_TMP_DIR, by path; concurrent uploads check free
+# space before any of them has written much, so each reserves its Content-Length up front
+tmp_dir_lock = threading.Lock()
+tmp_dir_reserved = 0
+tmp_dir_reservations = {}
+
+# Largest request body accepted by /upload (500 MiB by default)
+MAX_UPLOAD_BYTES = int(os.getenv('MAX_UPLOAD_BYTES', str(500 * 1024 * 1024)))
+
+# Largest text form field accepted alongside the video (1 MiB, Starlette's limit for non-file parts)
+MAX_FIELD_BYTES = 1024 * 1024
+
+# Accepted spellings of boolean form values, matching pydantic's bool coercion
+TRUE_VALUES = frozenset(('true', 't', '1', 'yes', 'y', 'on'))
+FALSE_VALUES = frozenset(('false', 'f', '0', 'no', 'n', 'off'))
+
+# Video file extensions accepted by /upload
+ALLOWED_EXTENSIONS = frozenset(('mp4', 'mov', 'webm', 'avi', 'wmv'))
+
+# Write size for streamed uploads (1 MiB); network chunks are coalesced up to this size
+WRITE_BUFSIZE = 1024 * 1024
+
+# Idle write buffers, reused across uploads instead of allocating one per request; at most
+# MAX_POOLED_BUFFERS are kept so a burst of uploads doesn't pin its peak memory for good
+write_buffers = []
+MAX_POOLED_BUFFERS = BROWSER_POOL_SIZE + 2
+
+# Pre-serialized /health body; orchestrators poll it often
+HEALTH_BODY = b'{"status":"healthy"}'
+
+# Pre-serialized bodies for requests rejected before any work is done, in the same
+# {"detail": ...} shape HTTPException produces
+ERR_BUSY = orjson.dumps({"detail": "Upload already in progress. Please wait."})
+ERR_QUEUE_FULL = orjson.dumps({"detail": "Too many uploads queued. Please wait."})
+ERR_NOT_MULTIPART = orjson.dumps({"detail": "Expected a multipart/form-data upload"})
+ERR_BAD_LENGTH = orjson.dumps({"detail": "Invalid Content-Length header"})
+ERR_TOO_LARGE = orjson.dumps({"detail": f"Upload exceeds the {MAX_UPLOAD_BYTES} byte limit"})
+ERR_NO_SPACE = orjson.dumps({"detail": "Not enough free space to store the upload"})
+
+# Form fields accepted by /upload alongside the video part
+FORM_FIELDS = (
+    'description', 'accountname', 'hashtags', 'sound_name', 'sound_aud_vol',
+    'schedule', 'day', 'copyrightcheck', 'headless', 'stealth'
+)
+
+# OpenAPI description of the multipart body, which the upload routes parse themselves. The video
+# comes last so clients built from it send accountname first and busy accounts are refused early
+FORM_FIELD_SCHEMAS = {
+    'day': {"type": "integer"},
+    'copyrightcheck': {"type": "boolean", "default": True},
+    'headless': {"type": "boolean"},
+    'stealth': {"type": "boolean"},
+    'sound_aud_vol': {"type": "string", "default": "mix"},
+}
+UPLOAD_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["description", "accountname", "video"],
+                    "properties": {
+                        **{name: FORM_FIELD_SCHEMAS.get(name, {"type": "string"}) for name in FORM_FIELDS},
+                        "video": {"type": "string", "format": "binary"},
+                    },
+                }
+            }
+        },
+    }
+}
+
+class RejectedRequest(Exception):
+    """Rejects a request with a pre-serialized JSON body, skipping per-request encoding."""
+
+    def __init__(self, status_code: int, body: bytes):
+        super().__init__(status_code)
+        self.status_code = status_code
+        self.body = body
+
+@app.exception_handler(RejectedRequest)
+async def rejected_request_handler(request: Request, exc: RejectedRequest):
+    return Response(content=exc.body, status_code=exc.status_code, media_type="application/json")
+
+def account_semaphore(accountname: str) -> asyncio.BoundedSemaphore:
+    """Return the upload semaphore for an account, creating it on first use."""
+    semaphore = account_semaphores.get(accountname)
+    if semaphore is None:
+        semaphore = account_semaphores[accountname] = asyncio.BoundedSemaphore(ACCOUNT_UPLOAD_LIMIT)
+    return semaphore
+
+def reject_busy_account(accountname: str):
+    """Raise 429 if accountname already has ACCOUNT_UPLOAD_LIMIT uploads in progress."""
+    semaphore = account_semaphores.get(accountname)
+    if semaphore is not None and semaphore.locked():
+        logger.warning(f"Account {accountname} is busy, rejecting request")
+        raise HTTPException(status_code=429, detail=f"Account {accountname} already has an upload in progress. Please wait.")
 
-def process_hashtags(hashtags: str) -> List[str]:
+def create_temp_video(expected_size: int) -> str:
     """
-    Process hashtags string into proper format.
-    Returns list of hashtags with # prefix.
+    Create the temp file a video of expected_size bytes will be streamed into and return its path.
+    Uses UPLOAD_TMP_DIR when it has room beyond the bytes already reserved there, reserving
+    expected_size until remove_temp_video; otherwise the system temp dir. Unknown sizes always
+    go to the system temp dir, and a 507 is raised when neither has room.
+    Calls statvfs, so run it off the event loop.
     """
-    if not hashtags:
+    global tmp_dir_reserved
+    with tmp_dir_lock:
+        video_dir = None
+        if expected_size > 0:
+            with contextlib.suppress(OSError):
+                if shutil.disk_usage(UPLOAD_TMP_DIR).free - tmp_dir_reserved > expected_size:
+                    video_dir = UPLOAD_TMP_DIR
+            if video_dir is None and shutil.disk_usage(tempfile.gettempdir()).free <= expected_size:
+                raise RejectedRequest(507, ERR_NO_SPACE)
+        fd, video_path = tempfile.mkstemp(suffix='.mp4', dir=video_dir)
+        os.close(fd)
+        if video_dir is not None:
+            tmp_dir_reserved += expected_size
+            tmp_dir_reservations[video_path] = expected_size
+    return video_path
+
+def release_temp_space(video_path: str):
+    """Return the UPLOAD_TMP_DIR space reserved for video_path by create_temp_video."""
+    global tmp_dir_reserved
+    with tmp_dir_lock:
+        tmp_dir_reserved -= tmp_dir_reservations.pop(video_path, 0)
+
+def parse_bool(name: str, value: Optional[str]) -> Optional[bool]:
+    """Parse a boolean form value, returning None when it is absent."""
+    if value is None:
         return None
-    
-    tags = hashtags.split(',')
-    processed_tags = [f'#{tag.lstrip("#").strip()}' for tag in tags if tag.strip()]
-    return processed_tags if processed_tags else None
-
-async def run_upload_in_thread(
-    video_path: str,
-    description: str,
-    accountname: str,
-    hashtags: Optional[str] = None,
-    sound_name: Optional[str] = None,
-    sound_aud_vol: Optional[str] = 'mix',
-    schedule: Optional[str] = None,
-    day: Optional[int] = None,
-    copyrightcheck: Optional[bool] = True,
-    headless: Optional[bool] = None,
-    stealth: Optional[bool] = None
-):
-    """Run the upload_tiktok function in a thread pool with detailed logging."""
-    processed_hashtags = process_hashtags(hashtags) if hashtags else None
-    
-    logger.info(f"Starting upload for account: {accountname}")
-    logger.info(f"Processed hashtags: {processed_hashtags}")
-    logger.info(f"Browser settings - headless: {headless}, stealth: {stealth}")
-    
-    if sound_name:
-        logger.info(f"Attempting to add sound: {sound_name} with volume: {sound_aud_vol}")
-    
-    # Ensure sound_aud_vol is valid
-    if sound_aud_vol not in ['mix', 'background', 'main']:
-        logger.warning(f"Invalid sound_aud_vol value: {sound_aud_vol}, defaulting to 'mix'")
-        sound_aud_vol = 'mix'
-
-    upload_func = partial(
-        upload_tiktok,
-        video=video_path,
-        description=description,
-        accountname=accountname,
-        hashtags=processed_hashtags,
-        sound_name=sound_name,
-        sound_aud_vol=sound_aud_vol,
-        schedule=schedule,
-        day=day,
-        copyrightcheck=copyrightcheck,
-        suppressprint=False,
-        headless=headless,
-        stealth=stealth
-    )
-    
+    lowered = value.lower()
+    if lowered in TRUE_VALUES:
+        return True
+    if lowered in FALSE_VALUES:
+        return False
+    raise HTTPException(status_code=422, detail=f"Invalid boolean value for {name}: {value}")
+
+def allowed_file(filename: Optional[str]) -> bool:
+    """Return True if filename has one of the ALLOWED_EXTENSIONS."""
+    _, dot, ext = (filename or '').rpartition('.')
+    return bool(dot) and ext.lower() in ALLOWED_EXTENSIONS
+
+class BufferedFileTarget(BaseTarget):
+    """
+    Streams a multipart part to disk in WRITE_BUFSIZE writes through a pooled buffer.
+    Hashes the part with SHA-256 as it arrives.
+    """
+
+    def __init__(self, filename: str):
+        super().__init__()
+        self.filename = filename
+        self.sha256 = hashlib.sha256()
+        self._file = None
+        self._buffer = None
+        self._filled = 0
+        self.finished = False
+
+    async def on_start_async(self):
+        # Refuse the part before any of it is written
+        if not allowed_file(self.multipart_filename):
+            raise HTTPException(status_code=415, detail=f"Invalid file type: {self.multipart_filename}")
+        self._file = await aiofiles.open(self.filename, 'wb')
+        self._buffer = write_buffers.pop() if write_buffers else bytearray(WRITE_BUFSIZE)
+
+    async def on_data_received_async(self, chunk: bytes):
+        self.sha256.update(chunk)
+        view = memoryview(chunk)
+        while view:
+            size = min(len(view), WRITE_BUFSIZE - self._filled)
+            self._buffer[self._filled:self._filled + size] = view[:size]
+            self._filled += size
+            view = view[size:]
+            if self._filled == WRITE_BUFSIZE:
+                await self._file.write(self._buffer)
+                self._filled = 0
+
+    async def on_finish_async(self):
+        if self._filled:
+            await self._file.write(memoryview(self._buffer)[:self._filled])
+        await self.aclose()
+        self.finished = True
+
+    async def aclose(self):
+        """Close the file and return the buffer to the pool; safe to call more than once."""
+        if self._file is not None:
+            await self._file.close()
+            self._file = None
+        if self._buffer is not None:
+            if len(write_buffers) < MAX_POOLED_BUFFERS:
+                write_buffers.append(self._buffer)
+            self._buffer = None
+
+class AccountTarget(ValueTarget):
+    """ValueTarget for accountname that rejects a busy account as soon as the field is parsed."""
+
+    async def on_finish_async(self):
+        # Undecodable names are reported once the whole form is parsed
+        with contextlib.suppress(UnicodeDecodeError):
+            reject_busy_account(self.value.decode())
+
+async def receive_upload(request: Request, video_path: str, reject_busy: bool = False) -> tuple:
+    """
+    Stream a multipart upload straight into video_path.
+    Returns (form, sha256) where form holds the remaining fields as keyword arguments
+    for run_upload_in_thread and sha256 is the hex digest of the video.
+    Stops reading once the body exceeds MAX_UPLOAD_BYTES, or with reject_busy set, as soon as
+    accountname names a busy account (clients should send it before the video part).
+    """
+    received = 0
+    video = BufferedFileTarget(video_path)
     try:
-        return await asyncio.to_thread(upload_func)
-    except Exception as e:
-        logger.error(f"Upload failed with error: {str(e)}")
-        raise
+        parser = StreamingFormDataParser(headers=request.headers)
+        parser.register('video', video)
+        targets = {name: ValueTarget(validator=MaxSizeValidator(MAX_FIELD_BYTES)) for name in FORM_FIELDS}
+        if reject_busy:
+            targets['accountname'] = AccountTarget(validator=MaxSizeValidator(MAX_FIELD_BYTES))
+        for name, target in targets.items():
+            parser.register(name, target)
 
-@app.get("/status")
-async def get_status():
-    """Get current upload status"""
-    return {
-        "upload_in_progress": upload_in_progress,
-        "service": "TikTok Uploader API"
-    }
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > MAX_UPLOAD_BYTES:
+                break
+            await parser.adata_received(chunk)
+    except ParseFailedException as e:
+        raise HTTPException(status_code=400, detail=f"Malformed multipart body: {str(e)}")
+    except ValidationError:
+        raise HTTPException(status_code=413, detail=f"Form field exceeds the {MAX_FIELD_BYTES} byte limit")
+    except ClientDisconnect:
+        raise HTTPException(status_code=400, detail="Client disconnected before the upload finished")
+    except OSError as e:
+        # Storage failures are ours, not the client's
+        logger.error(f"Failed to store upload: {str(e)}")
+        if e.errno == errno.ENOSPC:
+            raise RejectedRequest(507, ERR_NO_SPACE)
+        raise HTTPException(status_code=500, detail="Failed to store upload")
+    finally:
+        # Release the file and buffer even when parsing stopped mid-part
+        await video.aclose()
+
+    if received > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"Upload exceeds the {MAX_UPLOAD_BYTES} byte limit")
+
+    if video.multipart_filename is None:
+        raise HTTPException(status_code=422, detail="Missing form field: video")
+    if not video.finished:
+        # The body ended before the video part's closing boundary
+        raise HTTPException(status_code=400, detail="Incomplete multipart body: video part was truncated")
+
+    form = {}
+    for name, target in targets.items():
+        try:
+            form[name] = target.value.decode() or None
+        except UnicodeDecodeError:
+            raise HTTPException(status_code=422, detail=f"Invalid UTF-8 in form field: {name}")
+    for name in ('description', 'accountname'):
+        if form[name] is None:
+            raise HTTPException(status_code=422, detail=f"Missing form field: {name}")
+
+    if form['day'] is not None:
+        try:
+            form['day'] = int(form['day'])
+        except ValueError:
+            raise HTTPException(status_code=422, detail=f"Invalid integer value for day: {form['day']}")
+
+    copyrightcheck = parse_bool('copyrightcheck', form['copyrightcheck'])
+    form['copyrightcheck'] = True if copyrightcheck is None else copyrightcheck
+    form['headless'] = parse_bool('headless', form['headless'])
+    form['stealth'] = parse_bool('stealth', form['stealth'])
+    form['sound_aud_vol'] = form['sound_aud_vol'] or 'mix'
+    return form, video.sha256.hexdigest()
 
-@app.post("/upload")
-async def upload_video(
-    video: UploadFile = File(...),
-    description: str = Form(...),
-    accountname: str = Form(...),
-    hashtags: Optional[str] = Form(None),
-    sound_name: Optional[str] = Form(None),
-    sound_aud_vol: Optional[str] = Form('mix'),
-    schedule: Optional[str] = Form(None),
-    day: Optional[int] = Form(None),
-    copyrightcheck: Optional[bool] = Form(True),
-    headless: Optional[bool] = Form(None),
-    stealth: Optional[bool] = Form(None)
-):
-    global upload_in_progress
-    
-    # Check if upload is already in progress
+def check_upload_slot():
+    """Reject the request if the browser pool is exhausted, without reserving a slot."""
+    if active_uploads >= BROWSER_POOL_SIZE:
+        logger.warning("Upload already in progress, rejecting request")
+        raise RejectedRequest(429, ERR_BUSY)
+
+def acquire_upload_slot():
+    """Check out a browser slot, rejecting the request if the pool is exhausted."""
+    global active_uploads
     with upload_lock:
-        if upload_in_progress:
-            logger.warning("Upload already in progress, rejecting request")
-            raise HTTPException(status_code=429, detail="Upload already in progress. Please wait.")
-        upload_in_progress = True
-    
+        check_upload_slot()
+        active_uploads += 1
+
+async def wait_for_upload_slot():
+    """Check out a browser slot, waiting for one to be returned if the pool is exhausted."""
+    global active_uploads
+    while True:
+        with upload_lock:
+            if active_uploads < BROWSER_POOL_SIZE:
+                active_uploads += 1
+                return
+        slot_released.clear()
+        await slot_released.wait()
+
+def release_upload_slot():
+    """Return a browser slot taken by acquire_upload_slot or wait_for_upload_slot."""
+    global active_uploads
+    with upload_lock:
+        active_uploads -= 1
+    slot_released.set()
+
+async def remove_temp_video(video_path: Optional[str]):
+    """Delete a temp video without blocking the event loop and release its reserved space."""
+    try:
+        if video_path:
+            with contextlib.suppress(FileNotFoundError):
+                await asyncio.to_thread(os.unlink, video_path)
+    except Exception as cleanup_error:
+        logger.error(f"Cleanup failed: {str(cleanup_error)}")
+    finally:
+        if video_path:
+            release_temp_space(video_path)
+
+async def accept_upload(request: Request, wait: bool = False) -> tuple:
+    """
+    Stream the request's video into a temp file, then take a browser slot for it.
+    Returns (temp_video_path, form, sha256); the caller must release the slot and remove the file.
+    With wait set the upload will queue for its account and slot later (see perform_upload),
+    so no slot is taken and busy accounts are not rejected.
+    """
+    # Reject non-multipart and oversized uploads before taking a slot or allocating temp space
+    # Media types are case-insensitive
+    if not request.headers.get('content-type', '').lower().startswith('multipart/form-data'):
+        raise RejectedRequest(415, ERR_NOT_MULTIPART)
+    try:
+        content_length = int(request.headers.get('content-length') or 0)
+    except ValueError:
+        raise RejectedRequest(400, ERR_BAD_LENGTH)
+    if content_length < 0:
+        raise RejectedRequest(400, ERR_BAD_LENGTH)
+    if content_length > MAX_UPLOAD_BYTES:
+        raise RejectedRequest(413, ERR_TOO_LARGE)
+
+    # Fail fast while the pool is full, but only take the slot once the body is in so a
+    # slow client never holds a browser slot while no browser is running
+    if not wait:
+        check_upload_slot()
+
     temp_video_path = None
     try:
+        # Make sure the upload fits on disk before reading any of it
+        temp_video_path = await asyncio.to_thread(create_temp_video, content_length)
+
+        # Stream the video part directly into the temp file while parsing the form
+        form, sha256 = await receive_upload(request, temp_video_path, reject_busy=not wait)
+        accountname = form['accountname']
+
         logger.info(f"Received upload request for account: {accountname}")
-        logger.info(f"Sound parameters - name: {sound_name}, volume: {sound_aud_vol}")
+        logger.info(f"Sound parameters - name: {form['sound_name']}, volume: {form['sound_aud_vol']}")
         
         # Validate account and cookie
-        cookie_source = os.path.join(COOKIE_DIR, f'TK_cookies_{accountname}.json')
-        if not os.path.exists(cookie_source):
+        if not await asyncio.to_thread(os.path.exists, cookie_path(accountname)):
             raise HTTPException(status_code=400, detail=f"Cookie file not found for account {accountname}")
-        
-        # Handle video file
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.mp4') as temp_video:
-            shutil.copyfileobj(video.file, temp_video)
-            temp_video_path = temp_video.name
-            
-        # Copy cookie file
-        shutil.copy2(cookie_source, f'TK_cookies_{accountname}.json')
 
-        try:
-            # Attempt upload
-            await run_upload_in_thread(
-                video_path=temp_video_path,
-                description=description,
-                accountname=accountname,
-                hashtags=hashtags,
-                sound_name=sound_name,
-                sound_aud_vol=sound_aud_vol,
-                schedule=schedule,
-                day=day,
-                copyrightcheck=copyrightcheck,
-                headless=headless,
-                stealth=stealth
-            )
-            
-            return {"success": True, "message": "Video uploaded successfully"}
-            
-        except Exception as e:
-            error_msg = str(e)
-            if "SAVE AS DRAFT BUTTON NOT FOUND" in error_msg:
-                logger.error("Failed to save as draft - this might be due to account restrictions or permissions")
-                raise HTTPException(
-                    status_code=400,
-                    detail="Failed to add sound and couldn't save as draft. Please verify account permissions or try without sound."
-                )
-            raise
+        if not wait:
+            acquire_upload_slot()
+        return temp_video_path, form, sha256
 
     except Exception as e:
+        await remove_temp_video(temp_video_path)
+        if isinstance(e, (HTTPException, RejectedRequest)):
+            raise
         logger.error(f"Upload failed: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+
+async def perform_upload(video_path: str, form: dict, wait: bool = False, on_start=None):
+    """
+    Upload an accepted video to TikTok, mapping failures to HTTPException.
+    Rejects with 429 when the account is already at ACCOUNT_UPLOAD_LIMIT, unless wait is set.
+    With wait set, queues for the account and then for a browser slot, which it releases itself;
+    on_start is called once both are held.
+    """
+    if not wait:
+        reject_busy_account(form['accountname'])
+    semaphore = account_semaphore(form['accountname'])
+
+    try:
+        # Limit uploads per account to avoid cookie races and TikTok rate limits
+        async with semaphore:
+            if not wait:
+                await run_upload_in_thread(video_path=video_path, **form)
+            else:
+                # Take the slot only once the account is free, so a job queued behind
+                # another upload for its account never idles on a browser slot
+                await wait_for_upload_slot()
+                try:
+                    if on_start is not None:
+                        on_start()
+                    await run_upload_in_thread(video_path=video_path, **form)
+                finally:
+                    release_upload_slot()
+
+    except Exception as e:
+        error_msg = str(e)
+        if "SAVE AS DRAFT BUTTON NOT FOUND" in error_msg:
+            logger.error("Failed to save as draft - this might be due to account restrictions or permissions")
+            raise HTTPException(
+                status_code=400,
+                detail="Failed to add sound and couldn't save as draft. Please verify account permissions or try without sound."
+            )
+        logger.error(f"Upload failed: {error_msg}")
+        raise HTTPException(status_code=500, detail=error_msg)
+
+def prune_upload_jobs():
+    """Forget the oldest finished jobs once more than MAX_TRACKED_JOBS are tracked."""
+    for job_id in list(upload_jobs):
+        if len(upload_jobs) <= MAX_TRACKED_JOBS:
+            break
+        if upload_jobs[job_id]['status'] in ('succeeded', 'failed'):
+            del upload_jobs[job_id]
+
+def reserve_pending_job():
+    """Count a background upload against MAX_PENDING_JOBS, rejecting it if the queue is full."""
+    global pending_jobs
+    if pending_jobs >= MAX_PENDING_JOBS:
+        logger.warning("Upload queue is full, rejecting request")
+        raise RejectedRequest(429, ERR_QUEUE_FULL)
+    pending_jobs += 1
+
+def release_pending_job():
+    """Return a reservation taken by reserve_pending_job."""
+    global pending_jobs
+    pending_jobs -= 1
+
+async def run_upload_job(job_id: str, video_path: str, form: dict):
+    """Run an accepted upload in the background and record its outcome."""
+    job = upload_jobs[job_id]
+    try:
+        await perform_upload(video_path, form, wait=True, on_start=lambda: job.update(status='running'))
+        job['status'] = 'succeeded'
+    except HTTPException as e:
+        job['status'] = 'failed'
+        job['error'] = e.detail
+    finally:
+        release_pending_job()
+        await remove_temp_video(video_path)
+
+@app.get("/status")
+async def get_status():
+    """Get current upload status"""
+    return {
+        "upload_in_progress": active_uploads > 0,
+        "active_uploads": active_uploads,
+        "browser_pool_size": BROWSER_POOL_SIZE,
+        "service": "TikTok Uploader API"
+    }
+
+@app.get("/status/{task_id}")
+async def get_job_status(task_id: str):
+    """Get the state of an upload accepted by /upload/async"""
+    job = upload_jobs.get(task_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown task id {task_id}")
+    return {"task_id": task_id, **job}
+
+@app.post("/upload", openapi_extra=UPLOAD_OPENAPI)
+async def upload_video(request: Request):
+    temp_video_path, form, sha256 = await accept_upload(request)
+    try:
+        await perform_upload(temp_video_path, form)
+        return {"success": True, "message": "Video uploaded successfully", "sha256": sha256}
         
     finally:
-        # Always reset the upload flag
-        with upload_lock:
-            upload_in_progress = False
-            
-        # Cleanup
-        try:
-            if temp_video_path and os.path.exists(temp_video_path):
-                os.unlink(temp_video_path)
-            if os.path.exists(f'TK_cookies_{accountname}.json'):
-                os.unlink(f'TK_cookies_{accountname}.json')
-        except Exception as cleanup_error:
-            logger.error(f"Cleanup failed: {str(cleanup_error)}")
+        # Always return the browser slot
+        release_upload_slot()
+        await remove_temp_video(temp_video_path)
+
+@app.post("/upload/async", status_code=202, openapi_extra=UPLOAD_OPENAPI)
+async def upload_video_async(request: Request):
+    """Accept an upload and run it in the background; poll /status/{task_id} for the result."""
+    # Bound the staged videos waiting on the queue before reading any of the body
+    reserve_pending_job()
+    try:
+        # The job takes its browser slot once its account is free, not while it is queued
+        temp_video_path, form, sha256 = await accept_upload(request, wait=True)
+    except BaseException:
+        release_pending_job()
+        raise
+
+    job_id = uuid.uuid4().hex
+    upload_jobs[job_id] = {"status": "queued", "accountname": form['accountname'], "sha256": sha256, "error": None}
+    prune_upload_jobs()
+
+    task = asyncio.create_task(run_upload_job(job_id, temp_video_path, form))
+    background_jobs.add(task)
+    task.add_done_callback(background_jobs.discard)
+
+    return {"task_id": job_id, "status": "queued", "sha256": sha256}
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy"}
+    return Response(content=HEALTH_BODY, media_type="application/json")
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Upload slots and cookie caches are per process, so scale workers explicitly
+    # with WEB_CONCURRENCY; each worker runs up to BROWSER_POOL_SIZE browsers
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv('WEB_CONCURRENCY', '1')),
+        loop="uvloop",
+        http="httptools",
+        backlog=2048,
+        limit_concurrency=200
+    )
\ No newline at end of file
@@ -0,0 +1,156 @@
+from typing import Optional
+import os
+import time
+from tiktokautouploader import function as tiktok_function
+from tiktokautouploader import upload_tiktok, TikTokUploadError
+from hashtags import process_hashtags
+import logging
+import asyncio
+import contextlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+
+logger = logging.getLogger(__name__)
+
+# Get cookie directory from environment variable
+COOKIE_DIR = os.getenv('COOKIE_DIR', '/data/cookies')
+with contextlib.suppress(OSError):
+    os.makedirs(COOKIE_DIR, exist_ok=True)
+
+# Number of browser sessions allowed to run uploads at the same time
+BROWSER_POOL_SIZE = int(os.getenv('BROWSER_POOL_SIZE', '1'))
+
+# Dedicated threads for browser sessions so long uploads never tie up the
+# default executor used for file I/O
+upload_executor = ThreadPoolExecutor(max_workers=BROWSER_POOL_SIZE, thread_name_prefix='tiktok-upload')
+
+# Cookies whose expiry decides whether a stored TikTok session is still valid
+SESSION_COOKIES = ('sessionid', 'sid_tt', 'sessionid_ss', 'passport_auth_status')
+
+# Resource types blocked in the browser to save bandwidth and CPU. Images and
+# stylesheets are kept because the captcha solver and visibility checks need them.
+BLOCKED_RESOURCE_TYPES = frozenset(('font', 'media'))
+
+# Parsed cookies per account as (mtime_ns, cookies), least recently used first.
+# Entries are dropped when an upload fails or more than MAX_CACHED_ACCOUNTS are held.
+MAX_CACHED_ACCOUNTS = int(os.getenv('MAX_CACHED_ACCOUNTS', '64'))
+cookie_cache = OrderedDict()
+cookie_cache_lock = threading.Lock()
+
+@lru_cache(maxsize=512)
+def cookie_path(accountname: str) -> str:
+    """Return the path of the stored cookie file for an account."""
+    return os.path.join(COOKIE_DIR, f'TK_cookies_{accountname}.json')
+
+def load_cookies(accountname: str, proxy=None) -> list:
+    """
+    Load an account's cookies straight from COOKIE_DIR.
+    Replaces the uploader's loader, which only reads TK_cookies_<account>.json from the
+    working directory and falls back to an interactive login when cookies are missing.
+    Parsed cookies are reused until the file's mtime changes.
+    """
+    path = cookie_path(accountname)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        raise TikTokUploadError("ERROR: CANT READ COOKIES FILE")
+
+    with cookie_cache_lock:
+        cached = cookie_cache.get(accountname)
+        if cached and cached[0] == mtime:
+            cookie_cache.move_to_end(accountname)
+
+    if cached and cached[0] == mtime:
+        cookies = cached[1]
+    else:
+        cookies, _ = tiktok_function.read_cookies(cookies_path=path)
+        with cookie_cache_lock:
+            cookie_cache[accountname] = (mtime, cookies)
+            cookie_cache.move_to_end(accountname)
+            while len(cookie_cache) > MAX_CACHED_ACCOUNTS:
+                cookie_cache.popitem(last=False)
+
+    now = time.time()
+    expiries = [
+        cookie.get('expires') or cookie.get('expirationDate')
+        for cookie in cookies if cookie.get('name') in SESSION_COOKIES
+    ]
+    if not any(expiry is None or expiry >= now for expiry in expiries):
+        raise TikTokUploadError(f"COOKIES EXPIRED FOR ACCOUNT {accountname}, PLEASE LOG-IN AGAIN")
+    return cookies
+
+# Point the uploader at COOKIE_DIR so no per-request cookie copy is needed
+tiktok_function._load_or_create_cookies = load_cookies
+
+_make_stealth_context = tiktok_function._make_stealth_context
+
+def block_unneeded_resources(route):
+    """Abort requests for resource types the upload flow never uses."""
+    if route.request.resource_type in BLOCKED_RESOURCE_TYPES:
+        route.abort()
+    else:
+        route.continue_()
+
+def make_upload_context(p, headless, proxy):
+    """Create the uploader's browser context with unneeded resources blocked."""
+    browser, context = _make_stealth_context(p, headless=headless, proxy=proxy)
+    context.route('**/*', block_unneeded_resources)
+    return browser, context
+
+tiktok_function._make_stealth_context = make_upload_context
+
+async def run_upload_in_thread(
+    video_path: str,
+    description: str,
+    accountname: str,
+    hashtags: Optional[str] = None,
+    sound_name: Optional[str] = None,
+    sound_aud_vol: Optional[str] = 'mix',
+    schedule: Optional[str] = None,
+    day: Optional[int] = None,
+    copyrightcheck: Optional[bool] = True,
+    headless: Optional[bool] = None,
+    stealth: Optional[bool] = None
+):
+    """Run the upload_tiktok function on the upload executor with detailed logging."""
+    processed_hashtags = process_hashtags(hashtags)
+    
+    logger.info(f"Starting upload for account: {accountname}")
+    logger.info(f"Processed hashtags: {processed_hashtags}")
+    logger.info(f"Browser settings - headless: {headless}, stealth: {stealth}")
+    
+    if sound_name:
+        logger.info(f"Attempting to add sound: {sound_name} with volume: {sound_aud_vol}")
+    
+    # Ensure sound_aud_vol is valid
+    if sound_aud_vol not in ['mix', 'background', 'main']:
+        logger.warning(f"Invalid sound_aud_vol value: {sound_aud_vol}, defaulting to 'mix'")
+        sound_aud_vol = 'mix'
+
+    upload_func = partial(
+        upload_tiktok,
+        video=video_path,
+        description=description,
+        accountname=accountname,
+        hashtags=processed_hashtags,
+        sound_name=sound_name,
+        sound_aud_vol=sound_aud_vol,
+        schedule=schedule,
+        day=day,
+        copyrightcheck=copyrightcheck,
+        suppressprint=False,
+        headless=headless,
+        stealth=stealth
+    )
+    
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(upload_executor, upload_func)
+    except Exception as e:
+        logger.error(f"Upload failed with error: {str(e)}")
+        # The session may have been rejected, so re-read the cookies next time
+        with cookie_cache_lock:
+            cookie_cache.pop(accountname, None)
+        raise